@@ -1,4 +1,5 @@
 import argparse
+import threading
 
 import numpy as np
 import point_cloud_utils as pcu
@@ -88,9 +89,17 @@ def main():
     argparser.add_argument("--dtype", type=str, default="float64",
                            help="Scalar type of the data. Must be one of 'float32' or 'float64'. "
                                 "Warning: float32 may not work very well for complicated inputs.")
+    argparser.add_argument("--predict-dtype", type=str, default=None,
+                           help="Scalar type used to evaluate the fitted model on the voxel grid. Must be one of "
+                                "'float32' or 'float64'. Defaults to the value of --dtype. Fitting in float64 and "
+                                "evaluating in float32 makes evaluating the grid faster at a small cost in accuracy.")
     argparser.add_argument("--outer-layer-variance", type=float, default=0.001,
                            help="Variance of the outer layer of the neural network from which the neural "
                                 "spline kernel arises from. Default is 0.001.")
+    argparser.add_argument("--preconditioner-device", type=str, default="gpu",
+                           help="Where to build the FALKON preconditioner. Must be one of 'gpu', 'cpu', or 'auto'. "
+                                "'auto' builds small preconditioners (i.e. few Nyström samples) on the CPU "
+                                "and large ones on the GPU. Default is 'gpu'.")
     argparser.add_argument("--use-abs-units", action="store_true",
                            help="If set, then use absolute units instead of voxel units for --eps and --trim.")
     argparser.add_argument("--verbose", action="store_true", help="Spam your terminal with debug information")
@@ -103,6 +112,16 @@ def main():
     else:
         raise ValueError(f"invalid --dtype argument. Must be one of 'float32' or 'float64' but got {args.dtype}")
 
+    if args.predict_dtype is None:
+        predict_dtype = dtype
+    elif args.predict_dtype == "float64":
+        predict_dtype = torch.float64
+    elif args.predict_dtype == "float32":
+        predict_dtype = torch.float32
+    else:
+        raise ValueError(f"invalid --predict-dtype argument. Must be one of 'float32' or 'float64' "
+                         f"but got {args.predict_dtype}")
+
     if args.seed > 0:
         seed = args.seed
     else:
@@ -111,6 +130,10 @@ def main():
     np.random.seed(seed)
     print("Using random seed", seed)
 
+    # Create the CUDA context in the background so it overlaps with loading the input point cloud
+    if torch.cuda.is_available():
+        threading.Thread(target=lambda: torch.zeros(1, device='cuda'), daemon=True).start()
+
     x, n = load_point_cloud(args.input_point_cloud, dtype=dtype)
 
     scaled_bbox = point_cloud_bounding_box(x, args.scale)
@@ -120,10 +143,10 @@ def main():
     # Downsample points to grid resolution if there are enough points
     if x.shape[0] > args.voxel_downsample_threshold:
         print("Downsampling input point cloud to voxel resolution.")
-        x, n, _ = pcu.downsample_point_cloud_voxel_grid(voxel_size, x.numpy(), n.numpy(),
-                                                        min_bound=scaled_bbox[0],
-                                                        max_bound=scaled_bbox[0] + scaled_bbox[1])
-        x, n = torch.from_numpy(x), torch.from_numpy(n)
+        x_ds, n_ds, _ = pcu.downsample_point_cloud_voxel_grid(voxel_size, x.numpy(), n.numpy(),
+                                                              min_bound=scaled_bbox[0],
+                                                              max_bound=scaled_bbox[0] + scaled_bbox[1])
+        x, n = torch.as_tensor(x_ds, dtype=dtype), torch.as_tensor(n_ds, dtype=dtype)
 
     # Voxel grid to store the output
     out_grid = torch.zeros(*out_grid_size, dtype=torch.float32)
@@ -134,6 +157,12 @@ def main():
     # Iterate over each grid cell
     tqdm_bar = tqdm.tqdm(total=args.cells_per_axis ** 3)
     current_num_points = 0  # The number of points in this cell (used to log to the tqdm bar)
+
+    # Amount of voxels by which to pad each cell in each direction and the voxel index range of the whole grid
+    # (these are the same for every cell)
+    cell_pad_vox = torch.round(0.5 * args.overlap * out_grid_size.to(torch.float64) / args.cells_per_axis)
+    grid_vmin = torch.zeros(3, dtype=torch.int32)
+    grid_vmax = torch.tensor(out_grid.shape, dtype=torch.int32)
     for cell_idx, cell_vmin, cell_vmax in voxel_chunks(out_grid_size, args.cells_per_axis):
 
         tqdm_bar.set_postfix({"Cell": str(cell_idx), "Num Points": current_num_points})
@@ -147,12 +176,9 @@ def main():
             tqdm_bar.update(1)
             continue
 
-        # Amount of voxels by which to pad each cell in each direction
-        cell_pad_vox = torch.round(0.5 * args.overlap * out_grid_size.to(torch.float64) / args.cells_per_axis)
-
         # Minimum and maximum voxel indices of the padded cell
-        cell_pvmin = torch.maximum(cell_vmin - cell_pad_vox, torch.zeros(3).to(cell_vmin)).to(torch.int32)
-        cell_pvmax = torch.minimum(cell_vmax + cell_pad_vox, torch.tensor(out_grid.shape).to(cell_vmin)).to(torch.int32)
+        cell_pvmin = torch.maximum(cell_vmin - cell_pad_vox, grid_vmin).to(torch.int32)
+        cell_pvmax = torch.minimum(cell_vmax + cell_pad_vox, grid_vmax).to(torch.int32)
 
         # Bounding box and point mask for the padded cell
         cell_pad_amount = cell_pad_vox * voxel_size
@@ -183,10 +209,12 @@ def main():
                                                 kernel=args.kernel, reg=args.regularization, ny_mode=args.nystrom_mode,
                                                 cg_max_iters=args.cg_max_iters, cg_stop_thresh=args.cg_stop_thresh,
                                                 outer_layer_variance=args.outer_layer_variance,
+                                                preconditioner_device=args.preconditioner_device,
                                                 verbosity_level=7 if not args.verbose else 0,
                                                 normalize=False)
         cell_recon = eval_model_on_grid(cell_model, scaled_bbox, tx, out_grid_size,
-                                        cell_vox_min=idxmin, cell_vox_max=idxmax, print_message=False)
+                                        cell_vox_min=idxmin, cell_vox_max=idxmax, print_message=False,
+                                        predict_dtype=predict_dtype)
 
         w_cell_recon = weights * cell_recon
         out_grid[idxmin[0]:idxmax[0], idxmin[1]:idxmax[1], idxmin[2]:idxmax[2]] += w_cell_recon
@@ -194,13 +222,14 @@ def main():
         tqdm_bar.update(1)
 
     out_grid[torch.logical_not(out_mask)] = 1.0
+    out_grid, out_mask = out_grid.numpy(), out_mask.numpy()  # These live on the CPU so these are views (no copy)
     if args.save_grid:
-        np.savez(args.out + ".grid", grid=out_grid.detach().cpu().numpy(), mask=out_mask.detach().cpu().numpy(),
+        np.savez(args.out + ".grid", grid=out_grid, mask=out_mask,
                  bbox=[b.numpy() for b in scaled_bbox])
 
     # Erode the mask so we don't get weird boundaries
-    eroded_mask = binary_erosion(out_mask.numpy().astype(np.bool), np.ones([3, 3, 3]).astype(np.bool))
-    v, f, n, c = marching_cubes(out_grid.numpy(), level=0.0, mask=eroded_mask, spacing=voxel_size,
+    eroded_mask = binary_erosion(out_mask, np.ones([3, 3, 3], dtype=bool))
+    v, f, n, c = marching_cubes(out_grid, level=0.0, mask=eroded_mask, spacing=voxel_size,
                                 gradient_direction='ascent')
     v += scaled_bbox[0].numpy() + 0.5 * voxel_size.numpy()
 
@@ -213,8 +242,8 @@ def main():
             trim_dist_world = args.trim * torch.norm(voxel_size).item()
         nn_dist, _ = pcu.k_nearest_neighbors(v, x.numpy(), k=2)
         nn_dist = nn_dist[:, 1]
-        f_mask = np.stack([nn_dist[f[:, i]] < trim_dist_world for i in range(f.shape[1])], axis=-1)
-        f_mask = np.all(f_mask, axis=-1)
+        # Mark which vertices are close enough to the input, then keep faces whose vertices are all marked
+        f_mask = (nn_dist < trim_dist_world)[f].all(axis=-1)
         f = f[f_mask]
 
     pcu.save_mesh_vfn(args.out, v, f, n)
@@ -1,4 +1,5 @@
 import argparse
+import threading
 
 import numpy as np
 import point_cloud_utils as pcu
@@ -72,9 +73,17 @@ def main():
     argparser.add_argument("--dtype", type=str, default="float64",
                            help="Scalar type of the data. Must be one of 'float32' or 'float64'. "
                                 "Warning: float32 may not work very well for complicated inputs.")
+    argparser.add_argument("--predict-dtype", type=str, default=None,
+                           help="Scalar type used to evaluate the fitted model on the voxel grid. Must be one of "
+                                "'float32' or 'float64'. Defaults to the value of --dtype. Fitting in float64 and "
+                                "evaluating in float32 makes evaluating the grid faster at a small cost in accuracy.")
     argparser.add_argument("--outer-layer-variance", type=float, default=0.001,
                            help="Variance of the outer layer of the neural network from which the neural "
                                 "spline kernel arises from. Default is 0.001.")
+    argparser.add_argument("--preconditioner-device", type=str, default="gpu",
+                           help="Where to build the FALKON preconditioner. Must be one of 'gpu', 'cpu', or 'auto'. "
+                                "'auto' builds small preconditioners (i.e. few Nyström samples) on the CPU "
+                                "and large ones on the GPU. Default is 'gpu'.")
     argparser.add_argument("--use-abs-units", action="store_true",
                            help="If set, then use absolute units instead of voxel units for --eps and --trim.")
     argparser.add_argument("--verbose", action="store_true", help="Spam your terminal with debug information")
@@ -87,6 +96,16 @@ def main():
     else:
         raise ValueError(f"invalid --dtype argument. Must be one of 'float32' or 'float64' but got {args.dtype}")
 
+    if args.predict_dtype is None:
+        predict_dtype = dtype
+    elif args.predict_dtype == "float64":
+        predict_dtype = torch.float64
+    elif args.predict_dtype == "float32":
+        predict_dtype = torch.float32
+    else:
+        raise ValueError(f"invalid --predict-dtype argument. Must be one of 'float32' or 'float64' "
+                         f"but got {args.predict_dtype}")
+
     if args.seed > 0:
         seed = args.seed
     else:
@@ -95,6 +114,10 @@ def main():
     np.random.seed(seed)
     print("Using random seed", seed)
 
+    # Create the CUDA context in the background so it overlaps with loading the input point cloud
+    if torch.cuda.is_available():
+        threading.Thread(target=lambda: torch.zeros(1, device='cuda'), daemon=True).start()
+
     x, n = load_point_cloud(args.input_point_cloud, dtype=dtype)
 
     scaled_bbox = point_cloud_bounding_box(x, args.scale)
@@ -104,10 +127,10 @@ def main():
     # Downsample points to grid resolution if there are enough points
     if x.shape[0] > args.voxel_downsample_threshold:
         print("Downsampling input point cloud to voxel resolution.")
-        x, n, _ = pcu.downsample_point_cloud_voxel_grid(voxel_size, x.numpy(), n.numpy(),
-                                                        min_bound=scaled_bbox[0],
-                                                        max_bound=scaled_bbox[0] + scaled_bbox[1])
-        x, n = torch.from_numpy(x), torch.from_numpy(n)
+        x_ds, n_ds, _ = pcu.downsample_point_cloud_voxel_grid(voxel_size, x.numpy(), n.numpy(),
+                                                              min_bound=scaled_bbox[0],
+                                                              max_bound=scaled_bbox[0] + scaled_bbox[1])
+        x, n = torch.as_tensor(x_ds, dtype=dtype), torch.as_tensor(n_ds, dtype=dtype)
 
     # Finite differencing epsilon in world units
     if args.use_abs_units:
@@ -118,9 +141,11 @@ def main():
     model, tx = fit_model_to_pointcloud(x, n, num_ny=args.num_nystrom_samples, eps=eps_world_coords,
                                         kernel=args.kernel, reg=args.regularization, ny_mode=args.nystrom_mode,
                                         cg_max_iters=args.cg_max_iters, cg_stop_thresh=args.cg_stop_thresh,
-                                        outer_layer_variance=args.outer_layer_variance)
-    recon = eval_model_on_grid(model, scaled_bbox, tx, out_grid_size)
-    v, f, n, _ = marching_cubes(recon.numpy(), level=0.0, spacing=voxel_size)
+                                        outer_layer_variance=args.outer_layer_variance,
+                                        preconditioner_device=args.preconditioner_device)
+    recon = eval_model_on_grid(model, scaled_bbox, tx, out_grid_size, predict_dtype=predict_dtype)
+    recon = recon.numpy()  # The grid is already on the CPU so this is a view (no copy)
+    v, f, n, _ = marching_cubes(recon, level=0.0, spacing=voxel_size)
     v += scaled_bbox[0].numpy() + 0.5 * voxel_size.numpy()
 
     # Possibly trim regions which don't contain samples
@@ -132,13 +157,13 @@ def main():
             trim_dist_world = args.trim * torch.norm(voxel_size).item()
         nn_dist, _ = pcu.k_nearest_neighbors(v, x.numpy(), k=2)
         nn_dist = nn_dist[:, 1]
-        f_mask = np.stack([nn_dist[f[:, i]] < trim_dist_world for i in range(f.shape[1])], axis=-1)
-        f_mask = np.all(f_mask, axis=-1)
+        # Mark which vertices are close enough to the input, then keep faces whose vertices are all marked
+        f_mask = (nn_dist < trim_dist_world)[f].all(axis=-1)
         f = f[f_mask]
 
     pcu.save_mesh_vfn(args.out, v.astype(np.float32), f.astype(np.int32), n.astype(np.float32))
     if args.save_grid:
-        np.savez(args.out + ".grid", grid=recon.detach().cpu().numpy(), bbox=[b.numpy() for b in scaled_bbox])
+        np.savez(args.out + ".grid", grid=recon, bbox=[b.numpy() for b in scaled_bbox])
 
     if args.save_points:
         x_ny = model.ny_points_[:, :3] if model.ny_points_ is not None else None
@@ -1,3 +1,4 @@
+import copy
 import time
 import warnings
 
@@ -38,9 +39,10 @@ def _generate_nystrom_samples(x, num_samples, sampling_method, verbosity_level=1
     if x.shape[1] != 3:
         raise ValueError(f"Invalid shape for x, must be [N, 3] but got {x.shape}")
 
-    if x.shape[0] < num_samples:
+    if x.shape[0] <= num_samples:
         if verbosity_level <= _VERBOSITY_LEVEL_INFO:
-            print(f"Requested more Nyström samples ({num_samples}) than points ({x.shape[0]}) using all points.")
+            print(f"Requested at least as many Nyström samples ({num_samples}) as points ({x.shape[0]}) "
+                  f"using all points.")
         center_selector = 'uniform'
         x_ny = None
         ny_count = min(num_samples, x.shape[0])
@@ -57,17 +59,18 @@ def _generate_nystrom_samples(x, num_samples, sampling_method, verbosity_level=1
 
         # Allow generating +/- 5% of the requested samples so the algorighm converges fast
         sample_num_tolerance = 0.05
-        ny_idx = pcu.downsample_point_cloud_poisson_disk(x.numpy(), num_samples, random_seed=blue_noise_seed,
+        ny_idx = pcu.downsample_point_cloud_poisson_disk(x.contiguous().numpy(), num_samples,
+                                                         random_seed=blue_noise_seed,
                                                          sample_num_tolerance=sample_num_tolerance)
         x_ny = x[ny_idx]
-        x_ny = torch.cat([x_ny, torch.ones(x_ny.shape[0], 1).to(x_ny)], dim=-1)
+        x_ny = homogeneous_points(x_ny)
         ny_count = x_ny.shape[0]
         center_selector = FixedIndexSelector(idx=ny_idx)
     elif sampling_method == 'k-means':
         if verbosity_level <= _VERBOSITY_LEVEL_INFO:
             print("Generating k-means Nyström samples.")
         _, x_ny = kmeans(x.contiguous(), num_samples)
-        x_ny = torch.cat([x_ny, torch.ones(x_ny.shape[0], 1).to(x_ny)], dim=-1)
+        x_ny = homogeneous_points(x_ny)
         ny_count = x_ny.shape[0]
         center_selector = falkon.center_selection.FixedSelector(centers=x_ny, y_centers=None)
     else:
@@ -78,18 +81,28 @@ def _generate_nystrom_samples(x, num_samples, sampling_method, verbosity_level=1
 
 
 def _run_falkon_fit(x, y, penalty, num_ny, center_selector, kernel_type="neural-spline",
-                    maxiters=20, stop_thresh=1e-7, variance=1.0, falkon_opts=None, verbosity_level=1):
+                    maxiters=20, stop_thresh=1e-7, variance=1.0, falkon_opts=None, verbosity_level=1,
+                    preconditioner_device="gpu"):
+
+    if preconditioner_device not in ("auto", "cpu", "gpu"):
+        raise ValueError(f"Invalid preconditioner_device {preconditioner_device}, "
+                         f"expected one of 'auto', 'cpu', or 'gpu'")
 
     if falkon_opts is None:
         falkon_opts = falkon.FalkonOptions()
 
-        # Always use cuda for everything
-        falkon_opts.min_cuda_pc_size_64 = 1
-        falkon_opts.min_cuda_pc_size_32 = 1
+        # Always use cuda for the conjugate gradient iterations
         falkon_opts.min_cuda_iter_size_64 = 1
         falkon_opts.min_cuda_iter_size_32 = 1
         falkon_opts.use_cpu = False
 
+        # Build the preconditioner on the GPU, the CPU, or let FALKON decide based on the number of Nyström samples
+        if preconditioner_device == "gpu":
+            falkon_opts.min_cuda_pc_size_64 = 1
+            falkon_opts.min_cuda_pc_size_32 = 1
+        elif preconditioner_device == "cpu":
+            falkon_opts.cpu_preconditioner = True
+
         falkon_opts.cg_tolerance = stop_thresh
         falkon_opts.debug = verbosity_level <= _VERBOSITY_LEVEL_DEBUG
         falkon_opts.cg_print_when_done = verbosity_level <= _VERBOSITY_LEVEL_INFO
@@ -124,6 +137,23 @@ def _run_falkon_fit(x, y, penalty, num_ny, center_selector, kernel_type="neural-
     return model
 
 
+def _cast_model(model, dtype):
+    """
+    Get a fitted model whose coefficients and Nyström centers have the given dtype. The input model is not modified.
+    :param model: A fitted model returned from fit_model_to_pointcloud
+    :param dtype: The dtype of the returned model
+    :return: model if it already has the right dtype, otherwise a shallow copy of model converted to dtype
+    """
+    if model.alpha_.dtype == dtype:
+        return model
+
+    cast_model = copy.copy(model)
+    cast_model.alpha_ = model.alpha_.to(dtype)
+    if model.ny_points_ is not None:
+        cast_model.ny_points_ = model.ny_points_.to(dtype)
+    return cast_model
+
+
 def get_weights(vmin, vmax, pvmin, pvmax, weight_type):
     """
     Get the per-voxel partition of unity weights for a cell when reconstructing on a grid of cells
@@ -157,15 +187,17 @@ def load_point_cloud(filename, min_norm_normal=1e-5, dtype=torch.float64):
     n = n[idx]
 
     # Some meshes have non unit normals, so build a binary mask of points whose normal has a reasonable magnitude
-    # We use this mask to remove bad vertices
-    mask = np.linalg.norm(n, axis=-1) > min_norm_normal
+    # We use this mask to remove bad vertices. The norms are computed once and reused to normalize the normals we keep.
+    norm_n = np.sqrt(np.einsum('ij,ij->i', n, n))
+    mask = norm_n > min_norm_normal
 
-    # Keep the good points and normals
-    x = v[mask].astype(np.float64)
-    n = n[mask].astype(np.float64)
-    n /= np.linalg.norm(n, axis=-1, keepdims=True)
+    # Keep the good points and normals (these are already float64 since that's what we loaded,
+    # and masking makes a copy so we can normalize n in place)
+    x = v[mask]
+    n = n[mask]
+    n /= norm_n[mask][:, np.newaxis]
 
-    return torch.from_numpy(x).to(dtype), torch.from_numpy(n).to(dtype)
+    return torch.as_tensor(x, dtype=dtype), torch.as_tensor(n, dtype=dtype)
 
 
 def fit_model_to_pointcloud(x, n, num_ny, eps, kernel='neural-spline',
@@ -173,7 +205,7 @@ def fit_model_to_pointcloud(x, n, num_ny, eps, kernel='neural-spline',
                             cg_stop_thresh=1e-5, cg_max_iters=20,
                             outer_layer_variance=1.0,
                             verbosity_level=1, custom_falkon_opts=None,
-                            normalize=True):
+                            normalize=True, preconditioner_device="gpu"):
     """
     Fit a kernel to the point cloud with points x and normals n.
     :param x: A tensor of 3D points with shape [N, 3]
@@ -190,32 +222,39 @@ def fit_model_to_pointcloud(x, n, num_ny, eps, kernel='neural-spline',
     :param verbosity_level: How much should this function spam your terminal. 0 = debug, 1 = info, >5 = silent
     :param custom_falkon_opts: Object of type falkon.FalkonOptions object used to override the default solver settings
     :param normalize: If set, then normalize the point cloud to have zero mean
+    :param preconditioner_device: Where to build the preconditioner. Must be one of 'gpu', 'cpu', or 'auto'. 'auto'
+                                  uses FALKON's default thresholds so small preconditioners are built on the CPU.
+                                  Ignored if custom_falkon_opts is set.
     :return: A pair (model, tx) where model is a fitted neural spline model class (with the same API as scikit-learn)
              and tx is an affine transformation which converts world space samples to model coordinates.
              You *must* apply this transformation to points before evaluating the model.
              This transformation is represented as a tuple (t, s) where t is a translation and s is scale.
     """
-    x, y = triple_points_along_normals(x, n, eps, homogeneous=False)
+    # Build the homogeneous points Falkon fits to directly, and work with a view of their first three coordinates
+    # so we never hold a separate copy of the tripled point cloud
+    x, y = triple_points_along_normals(x, n, eps, homogeneous=True)
+    x_3d = x[:, :3]
 
     if normalize:
-        tx = normalize_pointcloud_transform(x)
+        tx = normalize_pointcloud_transform(x_3d)
+        translate, scale = tx
+        x_3d.add_(translate).mul_(scale)  # Same as affine_transform_pointcloud but in place
     else:
         tx = 0.0, 1.0
-    x = affine_transform_pointcloud(x, tx)
-
-    x_ny, center_selector, ny_count = _generate_nystrom_samples(x, num_ny, ny_mode, verbosity_level=verbosity_level)
 
-    x = torch.cat([x, torch.ones(x.shape[0], 1).to(x)], dim=-1)
+    x_ny, center_selector, ny_count = _generate_nystrom_samples(x_3d, num_ny, ny_mode, verbosity_level=verbosity_level)
 
     model = _run_falkon_fit(x, y, reg, ny_count, center_selector,
                             maxiters=cg_max_iters, stop_thresh=cg_stop_thresh,
                             kernel_type=kernel, variance=outer_layer_variance,
-                            verbosity_level=verbosity_level, falkon_opts=custom_falkon_opts)
+                            verbosity_level=verbosity_level, falkon_opts=custom_falkon_opts,
+                            preconditioner_device=preconditioner_device)
 
     return model, tx
 
 
-def eval_model_on_grid(model, bbox, tx, voxel_grid_size, cell_vox_min=None, cell_vox_max=None, print_message=True):
+def eval_model_on_grid(model, bbox, tx, voxel_grid_size, cell_vox_min=None, cell_vox_max=None, print_message=True,
+                       chunk_size=2 ** 22, predict_dtype=None):
     """
     Evaluate the trained model (output of fit_model_to_pointcloud) on a voxel grid.
     :param model: The trained model returned from fit_model_to_pointcloud
@@ -228,6 +267,11 @@ def eval_model_on_grid(model, bbox, tx, voxel_grid_size, cell_vox_min=None, cell
     :param cell_vox_min: If not None, reconstruct on the subset of the voxel grid starting at these indices.
     :param cell_vox_max: If not None, reconstruct on the subset of the voxel grid ending at these indices.
     :param print_message: If true, print status messages to stdout.
+    :param chunk_size: Evaluate the model on (approximately) this many grid points at a time. The grid is split into
+                       slabs along the first axis so we never materialize every grid point at once.
+    :param predict_dtype: The scalar type used to evaluate the model. If None, use the dtype the model was fitted with.
+                          torch.float32 halves the memory traffic of prediction compared to torch.float64, but can lose
+                          accuracy when the model coefficients are large (e.g. when using very little regularization).
     :return: A tensor representing the model evaluated on a grid.
     """
     bbox_origin, bbox_size = bbox
@@ -249,16 +293,27 @@ def eval_model_on_grid(model, bbox, tx, voxel_grid_size, cell_vox_min=None, cell
     xmin = affine_transform_pointcloud(xmin.unsqueeze(0), tx).squeeze()
     xmax = affine_transform_pointcloud(xmax.unsqueeze(0), tx).squeeze()
 
-    xmin, xmax = xmin.numpy(), xmax.numpy()
-    cell_vox_size = (cell_vox_max - cell_vox_min).numpy()
-
-    xgrid = np.stack([_.ravel() for _ in np.mgrid[xmin[0]:xmax[0]:cell_vox_size[0] * 1j,
-                                                  xmin[1]:xmax[1]:cell_vox_size[1] * 1j,
-                                                  xmin[2]:xmax[2]:cell_vox_size[2] * 1j]], axis=-1)
-    xgrid = torch.from_numpy(xgrid).to(model.alpha_.dtype)
-    xgrid = torch.cat([xgrid, torch.ones(xgrid.shape[0], 1).to(xgrid)], dim=-1).to(model.alpha_.dtype)
-
-    ygrid = model.predict(xgrid).reshape(tuple(cell_vox_size.astype(np.int))).detach().cpu()
+    # Build the grid points on the same device as the model so we don't pay for a host to device copy
+    if predict_dtype is not None:
+        model = _cast_model(model, predict_dtype)
+    dtype, device = model.alpha_.dtype, model.alpha_.device
+    cell_vox_size = [int(_) for _ in (cell_vox_max - cell_vox_min)]
+    xaxes = [torch.linspace(xmin[i].item(), xmax[i].item(), cell_vox_size[i], dtype=dtype, device=device)
+             for i in range(3)]
+
+    # Evaluate the model one slab of the grid at a time, copying each result to the (CPU) output grid.
+    # Slabs are written into a single buffer of homogeneous points whose last column of ones is only filled once.
+    ygrid = torch.empty(*cell_vox_size, dtype=dtype)
+    slab_size = min(max(1, chunk_size // (cell_vox_size[1] * cell_vox_size[2])), cell_vox_size[0])
+    xslab_buf = torch.empty(slab_size * cell_vox_size[1] * cell_vox_size[2], 4, dtype=dtype, device=device)
+    xslab_buf[:, 3] = 1.0
+    for i in range(0, cell_vox_size[0], slab_size):
+        slab_shape = (min(slab_size, cell_vox_size[0] - i), cell_vox_size[1], cell_vox_size[2])
+        xslab = xslab_buf[:slab_shape[0] * slab_shape[1] * slab_shape[2]]
+        xslab[:, 0].view(slab_shape).copy_(xaxes[0][i:i + slab_shape[0]].view(-1, 1, 1))
+        xslab[:, 1].view(slab_shape).copy_(xaxes[1].view(1, -1, 1))
+        xslab[:, 2].view(slab_shape).copy_(xaxes[2].view(1, 1, -1))
+        ygrid[i:i + slab_shape[0]] = model.predict(xslab).reshape(slab_shape).detach()
 
     if print_message:
         print(f"Evaluated model in {time.time() - eval_start_time}s.")
@@ -10,6 +10,10 @@ from falkon.options import FalkonOptions
 from falkon.sparse.sparse_tensor import SparseTensor
 from torch.utils.dlpack import to_dlpack
 
+# Set to True to print every call the Falkon solver makes into the kernels below. This is a module level constant
+# rather than a per-kernel attribute so the checks on the hot path are as cheap as possible.
+_DEBUG = False
+
 
 def _extract_float(d):
     if isinstance(d, torch.Tensor):
@@ -26,28 +30,187 @@ def _extract_float(d):
             raise TypeError("Item must be a scalar or a tensor.")
 
 
+def _compile_cuda_kernels(kernel_code, kernel_name='stable_kernel'):
+    """
+    Build one CuPy kernel per supported dtype from CUDA source which uses DTYPE as a placeholder scalar type.
+    CuPy compiles each kernel lazily on its first launch and caches it, so doing this once per kernel object means
+    we don't redo the source substitution and kernel lookup every time _apply is called.
+    :param kernel_code: CUDA source code where DTYPE stands for the scalar type
+    :param kernel_name: The name of the kernel function in kernel_code
+    :return: A dict mapping torch dtypes to pairs (kernel, cupy_dtype)
+    """
+    return {
+        torch.float32: (cp.RawKernel(kernel_code.replace("DTYPE", "float"), kernel_name), cp.float32),
+        torch.float64: (cp.RawKernel(kernel_code.replace("DTYPE", "double"), kernel_name), cp.float64),
+    }
+
+
+def _cached_scalar_tensors(cache, values, dtype, device):
+    """
+    Return the scalars in values as 1-element tensors with the given dtype and device, building them on first use
+    and reusing them on later calls so we don't allocate and copy new tensors to the device for every KeOps call.
+    :param cache: A dict, owned by the caller, mapping (dtype, device) pairs to lists of tensors
+    :param values: The scalar values to convert to tensors
+    :param dtype: The dtype of the returned tensors
+    :param device: The device of the returned tensors
+    :return: A list of 1-element tensors, one per value
+    """
+    key = (dtype, device)
+    if key not in cache:
+        cache[key] = [torch.tensor([val], dtype=dtype, device=device) for val in values]
+    return list(cache[key])
+
+
+# Number of entries of out which _apply evaluates at once on the CPU. This bounds the [rows, M] temporaries used to
+# compute the angles so they don't need to be accounted for in extra_mem.
+_CPU_BLOCK_SIZE = 2 ** 20
+
+
+def _norms_and_angle_blocks_torch(X1, X2, block_size=_CPU_BLOCK_SIZE):
+    """
+    PyTorch version of norms_and_angle in _ANGLE_CUDA_CODE, used by _apply when the inputs live on the CPU.
+    Like the CUDA code, this computes the angle as 2 * atan2(|ny * x - nx * y|, |ny * x + nx * y|) which doesn't suffer
+    from cancellation for (nearly) parallel points. Dividing by nx * ny doesn't change the angle so we compute
+    these with cdist between the normalized points.
+    The angles are computed over blocks of rows of X1 so the caller can evaluate the kernel one slice of out at a
+    time, and the temporaries (two [rows, M] tensors per block) stay small regardless of N.
+    :param X1: A tensor of N points (shape [N, D])
+    :param X2: A tensor of M points, transposed as Falkon passes it to _apply (shape [D, M])
+    :param block_size: The maximum number of entries in each [rows, M] block
+    :return: A generator of tuples (rows, x1_norms, x2_norms, angle, buf) where rows is the slice of X1 in the block,
+             x1_norms has shape [rows, 1], x2_norms has shape [1, M], angle[i, j] is the angle between X1[rows][i]
+             and X2[:, j] and buf is an uninitialized scratch tensor (both of shape [rows, M])
+    """
+    x2_norms = torch.norm(X2, dim=0, keepdim=True)
+    x2_unit = (X2 / x2_norms).T.contiguous()  # cdist would copy the transposed view on every call
+    rows_per_block = max(1, block_size // max(1, X2.shape[1]))
+    for i in range(0, X1.shape[0], rows_per_block):
+        rows = slice(i, min(i + rows_per_block, X1.shape[0]))
+        x1_norms = torch.norm(X1[rows], dim=1, keepdim=True)
+        x1_unit = X1[rows] / x1_norms
+        arg1 = torch.cdist(x1_unit, x2_unit, compute_mode='donot_use_mm_for_euclid_dist')
+        # |x + y| = |-x - y|, so negate the (small) block of X1 instead of making a negated copy of X2
+        arg2 = torch.cdist(x1_unit.neg_(), x2_unit, compute_mode='donot_use_mm_for_euclid_dist')
+        angle = torch.atan2(arg1, arg2, out=arg1).mul_(2.0)
+        yield rows, x1_norms, x2_norms, angle, arg2
+
+
+_ANGLE_CUDA_CODE = r'''
+#define PI (DTYPE) (3.1415926535897932384626433832795028841971693993751058209749445923078164062)
+#define ONE (DTYPE) (1.0)
+#define TILE 16   // Each block computes a TILE x TILE block of out (this must match threads_per_block in _apply)
+#define TILE_D 4  // Number of coordinates staged in shared memory at a time (our points are 4D homogeneous points)
+
+// Stage coordinates [k0, k0 + TILE_D) of the TILE rows of x1 and x2 used by this block in shared memory
+// (zero padded past the end of the matrices). x1 is a contiguous N x D matrix, while coordinate k of point j in x2
+// is x2[j * x2_sj + k * x2_sk] so x2 can be read in whatever layout Falkon passes it in without copying it first.
+__device__ void load_tiles(const DTYPE* x1, const DTYPE* x2, const int N, const int M, const int D,
+                           const int x2_sj, const int x2_sk, const int k0,
+                           DTYPE x1_tile[TILE][TILE_D + 1], DTYPE x2_tile[TILE][TILE_D + 1]) {
+    const int tid = threadIdx.y * blockDim.x + threadIdx.x;
+    if (tid < TILE * TILE_D) {
+        const int row = tid / TILE_D;
+        const int col = tid % TILE_D;
+        const int i = blockIdx.x * TILE + row;
+        const int j = blockIdx.y * TILE + row;
+        const int k = k0 + col;
+        x1_tile[row][col] = (i < N && k < D) ? x1[i * D + k] : (DTYPE) 0.0;
+        x2_tile[row][col] = (j < M && k < D) ? x2[j * x2_sj + k * x2_sk] : (DTYPE) 0.0;
+    }
+}
+
+// Look up the norms of x1[I] and x2[J] and compute the angle between them, where (I, J) is the entry of out for this
+// thread. The norms of the rows of x1 and x2 are computed once per _apply call (in x1_norms and x2_norms) so a single
+// loop over D is enough to compute the angle. Rows are read through shared memory so each block loads its rows of
+// x1 and x2 from global memory once, instead of once per thread. This synchronizes the block so every thread must call
+// it, even ones which lie outside of out.
+//
+// The angle is 2 * atan2(|ny * x - nx * y|, |ny * x + nx * y|). We accumulate both squared norms directly rather than
+// expanding them in terms of <x, y>, since nx * ny - <x, y> cancels catastrophically for (nearly) parallel points,
+// and every Nyström center coincides with an input point.
+__device__ void norms_and_angle(const DTYPE* x1, const DTYPE* x2, const DTYPE* x1_norms, const DTYPE* x2_norms,
+                                const int N, const int M, const int D, const int x2_sj, const int x2_sk,
+                                DTYPE* norm_x, DTYPE* norm_y, DTYPE* angle) {
+    __shared__ DTYPE x1_tile[TILE][TILE_D + 1];  // + 1 to avoid shared memory bank conflicts
+    __shared__ DTYPE x2_tile[TILE][TILE_D + 1];
+
+    const int I = blockIdx.x * TILE + threadIdx.x;
+    const int J = blockIdx.y * TILE + threadIdx.y;
+    const DTYPE nx = (I < N) ? x1_norms[I] : (DTYPE) 0.0;
+    const DTYPE ny = (J < M) ? x2_norms[J] : (DTYPE) 0.0;
+
+    DTYPE arg1 = (DTYPE) 0.0;
+    DTYPE arg2 = (DTYPE) 0.0;
+    for (int k0 = 0; k0 < D; k0 += TILE_D) {
+        load_tiles(x1, x2, N, M, D, x2_sj, x2_sk, k0, x1_tile, x2_tile);
+        __syncthreads();
+
+        #pragma unroll
+        for (int k = 0; k < TILE_D; k += 1) {
+            DTYPE a1 = ny * x1_tile[threadIdx.x][k] - nx * x2_tile[threadIdx.y][k];
+            DTYPE a2 = ny * x1_tile[threadIdx.x][k] + nx * x2_tile[threadIdx.y][k];
+            arg1 = fma(a1, a1, arg1);
+            arg2 = fma(a2, a2, arg2);
+        }
+        __syncthreads();
+    }
+    arg1 = sqrt(arg1);
+    arg2 = sqrt(arg2);
+
+    *norm_x = nx;
+    *norm_y = ny;
+    *angle = 2.0 * atan2(arg1, arg2);
+}
+'''
+
+
+_NEURAL_SPLINE_CUDA_CODE = _ANGLE_CUDA_CODE + r'''
+extern "C" __global__
+void stable_kernel(const DTYPE* x1, const DTYPE* x2, const DTYPE* x1_norms, const DTYPE* x2_norms, DTYPE* out,
+                   const double variance, const int N, int M, int D, int x2_sj, int x2_sk) {
+    const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
+    const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
+
+    DTYPE norm_x, norm_y, angle;
+    norms_and_angle(x1, x2, x1_norms, x2_norms, N, M, D, x2_sj, x2_sk, &norm_x, &norm_y, &angle);
+
+    if (I >= N || J >= M) {
+        return;
+    }
+
+    DTYPE norm_xy = norm_x * norm_y;
+    DTYPE sin_angle, cos_angle;
+    sincos(angle, &sin_angle, &cos_angle);  // One call instead of separate sin() and cos()
+    DTYPE opv = ONE + (DTYPE)(variance);
+    DTYPE K = norm_xy * (sin_angle + opv * (PI - angle) * cos_angle) / PI;
+    out[I * M + J] = K;
+}
+'''
+
+
 class NeuralSplineKernel(Kernel, KeopsKernelMixin, ABC):
     kernel_type = "angle"
 
     def __init__(self, variance: float = 1.0, opt: Optional[FalkonOptions] = None):
         super().__init__("NeuralSpline", self.kernel_type, opt)
-        self.debug = opt.debug if opt is not None else False
         self.variance = _extract_float(variance)
+        self._kernels = _compile_cuda_kernels(_NEURAL_SPLINE_CUDA_CODE)
+        self._const_cache = {}  # KeOps scalar parameters for each (dtype, device) pair
 
     def extra_mem(self):
         return {
-            # We transpose X2 in _apply
+            # X2 is read in place on the GPU, and the CPU path of _apply works on small blocks of rows
             'nd': 0,
-            'md': 1,
-            # Norm results in prepare
-            'm': 0,
-            'n': 0,
+            'md': 0,
+            # Norms of the rows of X1 and X2 in _apply
+            'm': 1,
+            'n': 1,
             # We do a copy in _apply
             'nm': 1,
         }
 
     def _keops_mmv_impl(self, X1, X2, v, kernel, out, opt):
-        if self.debug:
+        if _DEBUG:
             print(f"NeuralSpline._keops_mmv_impl(X1={X1.shape}, X2={X2.shape}, v, kernel, out, opt)")
 
         theta = 'two * Atan2(Norm2(Norm2(Y) * X - Norm2(X) * Y), Norm2(Norm2(Y) * X + Norm2(X) * Y))'
@@ -63,10 +226,8 @@ class NeuralSplineKernel(Kernel, KeopsKernelMixin, ABC):
             'one = Pm(1)',
             'two = Pm(1)'
         ]
-        other_vars = [torch.tensor([np.pi]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([self.variance]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([1.0]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([2.0]).to(dtype=X1.dtype, device=X1.device)]
+        other_vars = _cached_scalar_tensors(self._const_cache, (np.pi, self.variance, 1.0, 2.0),
+                                            X1.dtype, X1.device)
 
         return self.keops_mmv(X1, X2, v, out, formula, aliases, other_vars, opt)
 
@@ -83,7 +244,7 @@ class NeuralSplineKernel(Kernel, KeopsKernelMixin, ABC):
             return super()._decide_dmmv_impl(X1, X2, v, w, opt)
 
     def _prepare(self, X1, X2, **kwargs):
-        if self.debug:
+        if _DEBUG:
             print(f"NeuralSpline._prepare(X1={X1.shape}, X2={X2.shape}, *kwargs)")
         return []
 
@@ -91,114 +252,63 @@ class NeuralSplineKernel(Kernel, KeopsKernelMixin, ABC):
         raise NotImplementedError("NeuralSpline does not implement sparse prepare")
 
     def _apply(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
-        if self.debug:
+        if _DEBUG:
             print(f"NeuralSpline._apply(X1={X1.shape}, X2={X2.shape}, out={out.shape})")
 
-        kernel_code = r'''
-        #define PI (DTYPE) (3.1415926535897932384626433832795028841971693993751058209749445923078164062)
-        #define ONE (DTYPE) (1.0)
-        extern "C" __global__
-        void stable_kernel(const DTYPE* x1, const DTYPE* x2, DTYPE* out, const double variance, 
-                           const int N, int M, int D) {
-            const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
-            const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
-
-            if (I >= N || J >= M) {
-                return;
-            }
-
-            DTYPE norm_x = (DTYPE) 0.0; //normf(D, &x1[I*D]);
-            DTYPE norm_y = (DTYPE) 0.0; //normf(D, &x2[J*D]);
-
-            #pragma unroll 
-            for (int k = 0; k < D; k += 1) {
-                norm_x = fma(x1[I * D + k], x1[I * D + k], norm_x);
-                norm_y = fma(x2[J * D + k], x2[J * D + k], norm_y);
-            }
-            norm_x = sqrt(norm_x);
-            norm_y = sqrt(norm_y);
-
-            DTYPE arg1 = (DTYPE) 0.0;
-            DTYPE arg2 = (DTYPE) 0.0;
-
-            #pragma unroll
-            for (int k = 0; k < D; k += 1) {
-                DTYPE x1_ik = x1[I * D + k];
-                DTYPE x2_jk = x2[J * D + k];
-                DTYPE a1 = norm_y * x1_ik - norm_x * x2_jk;
-                DTYPE a2 = norm_y * x1_ik + norm_x * x2_jk;
-
-                arg1 = fma(a1, a1, arg1);
-                arg2 = fma(a2, a2, arg2);
-            }
-            arg1 = sqrt(arg1);
-            arg2 = sqrt(arg2);
-
-            DTYPE angle = 2.0 * atan2(arg1, arg2);
-
-            DTYPE norm_xy = norm_x * norm_y;
-            DTYPE cos_angle = cos(angle);
-            DTYPE sin_angle = sin(angle);
-            DTYPE opv = ONE + (DTYPE)(variance);
-            DTYPE K = norm_xy * (sin_angle + opv * (PI - angle) * cos_angle) / PI;
-            out[I * M + J] = K;
-        }
-        '''
         assert X1.dtype == X2.dtype == out.dtype, "X1, X2, and out don't have the same dtype"
         assert X1.device == X2.device == out.device, "X1, X2, and out are not on the same device"
+        if out.device.type == 'cpu':
+            self._apply_cpu(X1, X2, out)
+            return
         assert out.device.index is not None, "None device index"
 
-        if X1.dtype == torch.float32:
-            str_dtype = "float"
-            cupy_dtype = cp.float32
-        elif X1.dtype == torch.float64:
-            str_dtype = "double"
-            cupy_dtype = cp.float64
-        else:
+        if X1.dtype not in self._kernels:
             raise ValueError("Invalid dtype must be float32 or float64")
+        kernel, cupy_dtype = self._kernels[X1.dtype]
 
-        kernel_code = kernel_code.replace("DTYPE", str_dtype)
-        kernel = cp.RawKernel(kernel_code, 'stable_kernel')
+        # X2 is passed in transposed (shape [D, M]). Rather than copying it back to a contiguous [M, D] matrix, we
+        # pass its strides to the CUDA kernel which reads it in place.
+        X1 = X1.contiguous()  # This should be a no-op but add it in for good measure
 
-        # The .contiguous should be a no-op in both these cases, but add them in for good measure
-        X1 = X1.contiguous()
-        X2 = X2.T.contiguous()
-
-        # Convert X1 and X2 to CuPy arrays.
+        # Convert X1, X2 and their row norms to CuPy arrays.
         x1cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X1))
         x2cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X2))
-        with cp.cuda.Device(out.device.index):
+        x1_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X1, dim=1)))
+        x2_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X2, dim=0)))
+        # Launch on PyTorch's current stream so the CUDA kernel is ordered after the torch.norm calls above
+        # (Falkon may call _apply from inside a non-default torch stream)
+        torch_stream = torch.cuda.current_stream(out.device)
+        with cp.cuda.Device(out.device.index), cp.cuda.ExternalStream(torch_stream.cuda_stream):
             outcp = cp.zeros((out.shape[0], out.shape[1]), dtype=cupy_dtype)
 
-        # Run the CUDA kernel to build the matrix K
-        pt_dim = int(X1.shape[1])
-        dims = int(X1.shape[0]), int(X2.shape[0])
-        threads_per_block = (16, 16)  # TODO: Maybe hardcoding this is bad
-        blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
-        kernel(blocks_per_grid, threads_per_block, (x1cp, x2cp, outcp, self.variance, dims[0], dims[1], pt_dim))
-        cp.cuda.stream.get_current_stream().synchronize()  # Need to synchronize so we can copy to PyTorch
+            # Run the CUDA kernel to build the matrix K
+            pt_dim = int(X1.shape[1])
+            dims = int(X1.shape[0]), int(X2.shape[1])
+            x2_strides = int(X2.stride(1)), int(X2.stride(0))
+            threads_per_block = (16, 16)  # Must match TILE in the CUDA source
+            blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
+            kernel(blocks_per_grid, threads_per_block,
+                   (x1cp, x2cp, x1_norms_cp, x2_norms_cp, outcp, self.variance, dims[0], dims[1], pt_dim, *x2_strides))
+        torch_stream.synchronize()  # Need to synchronize so we can copy to PyTorch
 
-        # print("COPYING CUPY OUT TO PYTORCH")
-        # print("OUT CUPY\n", outcp)
         # Copy the kernel back into the output PyTorch tensor
         outcp_dlpack = outcp.toDlpack()
         out_dlpack = torch.utils.dlpack.from_dlpack(outcp_dlpack)
         out.copy_(out_dlpack)
-        # print("OUT PYTORCH\n", out)
 
-        # rand_idx_i, rand_idx_j = np.random.randint(X1.shape[0]), np.random.randint(X2.shape[0])
-        # xi, xj = X1[rand_idx_i].detach().cpu().numpy(), X2[rand_idx_j].detach().cpu().numpy()
-        # nxi, nxj = np.linalg.norm(xi), np.linalg.norm(xj)
-        # angle1, angle2 = np.linalg.norm(nxj * xi - nxi * xj), np.linalg.norm(nxj * xi + nxi * xj)
-        # angle = 2.0 * np.arctan2(angle1, angle2)
-        # kij = nxi * nxj * (np.sin(angle) + (1.0 + self.variance) * (np.pi - angle) * np.cos(angle)) / np.pi
-        # print(np.abs(kij - out[rand_idx_i, rand_idx_j].item()))
+    def _apply_cpu(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
+        opv = 1.0 + self.variance
+        for rows, x1_norms, x2_norms, angle, buf in _norms_and_angle_blocks_torch(X1, X2):
+            out_rows = out[rows]
+            cos_angle = torch.cos(angle, out=buf)
+            torch.neg(angle, out=out_rows).add_(np.pi).mul_(cos_angle).mul_(opv)  # opv * (pi - angle) * cos(angle)
+            out_rows.add_(angle.sin_()).mul_(x1_norms).mul_(x2_norms).div_(np.pi)
 
     def _apply_sparse(self, X1: SparseTensor, X2: SparseTensor, out: torch.Tensor):
         raise NotImplementedError("NeuralSpline does not implement sparse apply")
 
     def _finalize(self, A: torch.Tensor, d):
-        if self.debug:
+        if _DEBUG:
             print(f"NeuralSpline._finalize(A={A.shape}, d)")
         return A
 
@@ -209,48 +319,85 @@ class NeuralSplineKernel(Kernel, KeopsKernelMixin, ABC):
         return self.__str__()
 
 
+_LAPLACE_SPHERE_CUDA_CODE = _ANGLE_CUDA_CODE + r'''
+__POW_GAMMA_DEFINE__
+
+extern "C" __global__
+void stable_kernel(const DTYPE* x1, const DTYPE* x2, const DTYPE* x1_norms, const DTYPE* x2_norms, DTYPE* out,
+                   const double alpha, double gamma, const int N, int M, int D, int x2_sj, int x2_sk) {
+    const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
+    const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
+
+    DTYPE norm_x, norm_y, angle;
+    norms_and_angle(x1, x2, x1_norms, x2_norms, N, M, D, x2_sj, x2_sk, &norm_x, &norm_y, &angle);
+
+    if (I >= N || J >= M) {
+        return;
+    }
+
+    DTYPE norm_xy = norm_x * norm_y;
+    DTYPE cos_angle = cos(angle);
+    DTYPE K = norm_xy * exp((DTYPE) alpha * POW_GAMMA(ONE - cos_angle));
+    out[I * M + J] = K;
+}
+'''
+
+
 class LaplaceKernelSphere(Kernel, KeopsKernelMixin, ABC):
     kernel_type = "angle"
 
     def __init__(self, alpha, gamma, opt: Optional[FalkonOptions] = None):
         super().__init__("LaplaceKernelSphere", self.kernel_type, opt)
-        self.debug = opt.debug if opt is not None else False
         self.alpha = _extract_float(alpha)
         self.gamma = _extract_float(gamma)
 
+        # Specialize (1 - cos(theta))^gamma for the common values of gamma since pow is a lot slower than sqrt
+        self._pow_gamma_is_generic = self.gamma not in (0.5, 1.0)
+        if self.gamma == 0.5:
+            cuda_pow_gamma, self._keops_pow_gamma = 'sqrt(x)', 'Sqrt({})'
+        elif self.gamma == 1.0:
+            cuda_pow_gamma, self._keops_pow_gamma = '(x)', '({})'
+        else:
+            cuda_pow_gamma, self._keops_pow_gamma = 'pow(x, (DTYPE) gamma)', 'Powf({}, gamma)'
+        self._kernels = _compile_cuda_kernels(
+            _LAPLACE_SPHERE_CUDA_CODE.replace("__POW_GAMMA_DEFINE__", f"#define POW_GAMMA(x) {cuda_pow_gamma}\n"))
+        self._const_cache = {}  # KeOps scalar parameters for each (dtype, device) pair
+
     def extra_mem(self):
         return {
-            # We transpose X2 in _apply
+            # X2 is read in place on the GPU, and the CPU path of _apply works on small blocks of rows
             'nd': 0,
-            'md': 1,
-            # Norm results in prepare
-            'm': 0,
-            'n': 0,
+            'md': 0,
+            # Norms of the rows of X1 and X2 in _apply
+            'm': 1,
+            'n': 1,
             # We do a copy in _apply
             'nm': 1,
         }
 
     def _keops_mmv_impl(self, X1, X2, v, kernel, out, opt):
-        if self.debug:
+        if _DEBUG:
             print("LaplaceKernelSphere._keops_mmv_impl(X1, X2, v, kernel, out, opt)")
 
         theta = 'two * Atan2(Norm2(Norm2(Y) * X - Norm2(X) * Y), Norm2(Norm2(Y) * X + Norm2(X) * Y))'
         norm_xy = '(Norm2(X) * Norm2(Y))'
-        j01 = f'({norm_xy} * (Exp(alpha * Powf(one - Cos({theta}), gamma))))'
+        pow_gamma = self._keops_pow_gamma.format(f'one - Cos({theta})')
+        j01 = f'({norm_xy} * (Exp(alpha * {pow_gamma})))'
         formula = f'({j01}) * v'
         aliases = [
             'X = Vi(%d)' % (X1.shape[1]),
             'Y = Vj(%d)' % (X2.shape[1]),
             'v = Vj(%d)' % (v.shape[1]),
             'alpha = Pm(1)',
-            'gamma = Pm(1)',
             'one = Pm(1)',
             'two = Pm(1)',
         ]
-        other_vars = [torch.tensor([self.alpha]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([self.gamma]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([1.0]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([2.0]).to(dtype=X1.dtype, device=X1.device)]
+        params = (self.alpha, 1.0, 2.0)
+        if self._pow_gamma_is_generic:
+            # Only pass gamma to KeOps if the formula uses it
+            aliases.append('gamma = Pm(1)')
+            params += (self.gamma,)
+        other_vars = _cached_scalar_tensors(self._const_cache, params, X1.dtype, X1.device)
 
         return self.keops_mmv(X1, X2, v, out, formula, aliases, other_vars, opt)
 
@@ -267,7 +414,7 @@ class LaplaceKernelSphere(Kernel, KeopsKernelMixin, ABC):
             return super()._decide_dmmv_impl(X1, X2, v, w, opt)
 
     def _prepare(self, X1, X2, **kwargs):
-        if self.debug:
+        if _DEBUG:
             print("LaplaceKernelSphere._prepare(X1, X2, *kwargs)")
         return []
 
@@ -275,101 +422,61 @@ class LaplaceKernelSphere(Kernel, KeopsKernelMixin, ABC):
         raise NotImplementedError("LaplaceKernelSphere does not implement sparse prepare")
 
     def _apply(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
-        if self.debug:
+        if _DEBUG:
             print("LaplaceKernelSphere._apply(X1, X2, out)")
-        kernel_code = r'''
-         #define PI (DTYPE) (3.1415926535897932384626433832795028841971693993751058209749445923078164062)
-         #define ONE (DTYPE) (1.0)
-         extern "C" __global__
-         void stable_kernel(const DTYPE* x1, const DTYPE* x2, DTYPE* out, const double alpha, double gamma, 
-                            const int N, int M, int D) {
-             const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
-             const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
-
-             if (I >= N || J >= M) {
-                 return;
-             }
-
-             DTYPE norm_x = (DTYPE) 0.0; //normf(D, &x1[I*D]);
-             DTYPE norm_y = (DTYPE) 0.0; //normf(D, &x2[J*D]);
-
-             #pragma unroll 
-             for (int k = 0; k < D; k += 1) {
-                 norm_x = fma(x1[I * D + k], x1[I * D + k], norm_x);
-                 norm_y = fma(x2[J * D + k], x2[J * D + k], norm_y);
-             }
-             norm_x = sqrt(norm_x);
-             norm_y = sqrt(norm_y);
-
-             DTYPE arg1 = (DTYPE) 0.0;
-             DTYPE arg2 = (DTYPE) 0.0;
-
-             #pragma unroll
-             for (int k = 0; k < D; k += 1) {
-                 DTYPE x1_ik = x1[I * D + k];
-                 DTYPE x2_jk = x2[J * D + k];
-                 DTYPE a1 = norm_y * x1_ik - norm_x * x2_jk;
-                 DTYPE a2 = norm_y * x1_ik + norm_x * x2_jk;
-
-                 arg1 = fma(a1, a1, arg1);
-                 arg2 = fma(a2, a2, arg2);
-             }
-             arg1 = sqrt(arg1);
-             arg2 = sqrt(arg2);
-
-             DTYPE angle = 2.0 * atan2(arg1, arg2);
-
-             DTYPE norm_xy = norm_x * norm_y;
-             DTYPE cos_angle = cos(angle);
-             DTYPE K = norm_xy * exp((DTYPE) alpha * pow(ONE - cos_angle, (DTYPE) gamma));
-             out[I * M + J] = K;
-         }
-         '''
         assert X1.dtype == X2.dtype == out.dtype, "X1, X2, and out don't have the same dtype"
         assert X1.device == X2.device == out.device, "X1, X2, and out are not on the same device"
+        if out.device.type == 'cpu':
+            self._apply_cpu(X1, X2, out)
+            return
         assert out.device.index is not None, "None device index"
 
-        if X1.dtype == torch.float32:
-            str_dtype = "float"
-            cupy_dtype = cp.float32
-        elif X1.dtype == torch.float64:
-            str_dtype = "double"
-            cupy_dtype = cp.float64
-        else:
+        if X1.dtype not in self._kernels:
             raise ValueError("Invalid dtype must be float32 or float64")
+        kernel, cupy_dtype = self._kernels[X1.dtype]
 
-        kernel_code = kernel_code.replace("DTYPE", str_dtype)
-        kernel = cp.RawKernel(kernel_code, 'stable_kernel')
-
-        # The .contiguous should be a no-op in both these cases, but add them in for good measure
-        X1 = X1.contiguous()
-        X2 = X2.T.contiguous()
+        # X2 is passed in transposed (shape [D, M]). Rather than copying it back to a contiguous [M, D] matrix, we
+        # pass its strides to the CUDA kernel which reads it in place.
+        X1 = X1.contiguous()  # This should be a no-op but add it in for good measure
 
-        # Convert X1 and X2 to CuPy arrays.
+        # Convert X1, X2 and their row norms to CuPy arrays.
         x1cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X1))
         x2cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X2))
-        with cp.cuda.Device(out.device.index):
+        x1_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X1, dim=1)))
+        x2_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X2, dim=0)))
+        # Launch on PyTorch's current stream so the CUDA kernel is ordered after the torch.norm calls above
+        # (Falkon may call _apply from inside a non-default torch stream)
+        torch_stream = torch.cuda.current_stream(out.device)
+        with cp.cuda.Device(out.device.index), cp.cuda.ExternalStream(torch_stream.cuda_stream):
             outcp = cp.zeros((out.shape[0], out.shape[1]), dtype=cupy_dtype)
 
-        # Run the CUDA kernel to build the matrix K
-        pt_dim = int(X1.shape[1])
-        dims = int(X1.shape[0]), int(X2.shape[0])
-        threads_per_block = (16, 16)  # TODO: Maybe hardcoding this is bad
-        blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
-        kernel(blocks_per_grid, threads_per_block,
-               (x1cp, x2cp, outcp, self.alpha, self.gamma, dims[0], dims[1], pt_dim))
-        cp.cuda.stream.get_current_stream().synchronize()  # Need to synchronize so we can copy to PyTorch
+            # Run the CUDA kernel to build the matrix K
+            pt_dim = int(X1.shape[1])
+            dims = int(X1.shape[0]), int(X2.shape[1])
+            x2_strides = int(X2.stride(1)), int(X2.stride(0))
+            threads_per_block = (16, 16)  # Must match TILE in the CUDA source
+            blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
+            kernel(blocks_per_grid, threads_per_block,
+                   (x1cp, x2cp, x1_norms_cp, x2_norms_cp, outcp, self.alpha, self.gamma,
+                    dims[0], dims[1], pt_dim, *x2_strides))
+        torch_stream.synchronize()  # Need to synchronize so we can copy to PyTorch
 
         # Copy the kernel back into the output PyTorch tensor
         outcp_dlpack = outcp.toDlpack()
         out_dlpack = torch.utils.dlpack.from_dlpack(outcp_dlpack)
         out.copy_(out_dlpack)
 
+    def _apply_cpu(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
+        for rows, x1_norms, x2_norms, angle, _ in _norms_and_angle_blocks_torch(X1, X2):
+            out_rows = out[rows]
+            torch.cos(angle, out=out_rows).neg_().add_(1.0).pow_(self.gamma).mul_(self.alpha).exp_()
+            out_rows.mul_(x1_norms).mul_(x2_norms)
+
     def _apply_sparse(self, X1: SparseTensor, X2: SparseTensor, out: torch.Tensor):
         raise NotImplementedError("LaplaceKernelSphere does not implement sparse apply")
 
     def _finalize(self, A, d):
-        if self.debug:
+        if _DEBUG:
             print("LaplaceKernelSphere._finalize(A, d)")
         return A
 
@@ -380,28 +487,58 @@ class LaplaceKernelSphere(Kernel, KeopsKernelMixin, ABC):
         return self.__str__()
 
 
+_LINEAR_ANGLE_CUDA_CODE = _ANGLE_CUDA_CODE + r'''
+__MUL_NORM_DEFINE__
+
+extern "C" __global__
+void stable_kernel(const DTYPE* x1, const DTYPE* x2, const DTYPE* x1_norms, const DTYPE* x2_norms, DTYPE* out,
+                   const int N, int M, int D, int x2_sj, int x2_sk) {
+    const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
+    const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
+
+    DTYPE norm_x, norm_y, angle;
+    norms_and_angle(x1, x2, x1_norms, x2_norms, N, M, D, x2_sj, x2_sk, &norm_x, &norm_y, &angle);
+
+    if (I >= N || J >= M) {
+        return;
+    }
+
+    #ifdef MULTIPLY_NORM
+    DTYPE norm_xy = norm_x * norm_y;
+    DTYPE K = norm_xy * (PI - angle) / PI;
+    #else
+    DTYPE K = (PI - angle) / PI;
+    #endif
+
+    out[I * M + J] = K;
+}
+'''
+
+
 class LinearAngleKernel(Kernel, KeopsKernelMixin, ABC):
     kernel_type = "angle"
 
     def __init__(self, multiply_norm=False, opt: Optional[FalkonOptions] = None):
         super().__init__("LinearAngleKernel", self.kernel_type, opt)
-        self.debug = opt.debug if opt is not None else False
         self.multiply_norm = multiply_norm
+        mul_norm_define = "#define MULTIPLY_NORM\n" if multiply_norm else "\n"
+        self._kernels = _compile_cuda_kernels(_LINEAR_ANGLE_CUDA_CODE.replace("__MUL_NORM_DEFINE__", mul_norm_define))
+        self._const_cache = {}  # KeOps scalar parameters for each (dtype, device) pair
 
     def extra_mem(self):
         return {
-            # We transpose X2 in _apply
+            # X2 is read in place on the GPU, and the CPU path of _apply works on small blocks of rows
             'nd': 0,
-            'md': 1,
-            # Norm results in prepare
-            'm': 0,
-            'n': 0,
+            'md': 0,
+            # Norms of the rows of X1 and X2 in _apply
+            'm': 1,
+            'n': 1,
             # We do a copy in _apply
             'nm': 1,
         }
 
     def _keops_mmv_impl(self, X1, X2, v, kernel, out, opt):
-        if self.debug:
+        if _DEBUG:
             print(f"LinearAngleKernel._keops_mmv_impl(X1={X1.shape}, X2={X2.shape}, v, kernel, out, opt)")
 
         theta = 'two * Atan2(Norm2(Norm2(Y) * X - Norm2(X) * Y), Norm2(Norm2(Y) * X + Norm2(X) * Y))'
@@ -418,8 +555,7 @@ class LinearAngleKernel(Kernel, KeopsKernelMixin, ABC):
             'pi = Pm(1)',
             'two = Pm(1)'
         ]
-        other_vars = [torch.tensor([np.pi]).to(dtype=X1.dtype, device=X1.device),
-                      torch.tensor([2.0]).to(dtype=X1.dtype, device=X1.device)]
+        other_vars = _cached_scalar_tensors(self._const_cache, (np.pi, 2.0), X1.dtype, X1.device)
 
         return self.keops_mmv(X1, X2, v, out, formula, aliases, other_vars, opt)
 
@@ -436,7 +572,7 @@ class LinearAngleKernel(Kernel, KeopsKernelMixin, ABC):
             return super()._decide_dmmv_impl(X1, X2, v, w, opt)
 
     def _prepare(self, X1, X2, **kwargs):
-        if self.debug:
+        if _DEBUG:
             print(f"LinearAngleKernel._prepare(X1={X1.shape}, X2={X2.shape}, *kwargs)")
         return []
 
@@ -444,122 +580,62 @@ class LinearAngleKernel(Kernel, KeopsKernelMixin, ABC):
         raise NotImplementedError("LinearAngleKernel does not implement sparse prepare")
 
     def _apply(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
-        if self.debug:
+        if _DEBUG:
             print(f"LinearAngleKernel._apply(X1={X1.shape}, X2={X2.shape}, out={out.shape})")
 
-        kernel_code = r'''
-        #define PI (DTYPE) (3.1415926535897932384626433832795028841971693993751058209749445923078164062)
-        #define ONE (DTYPE) (1.0)
-        __MUL_NORM_DEFINE__
-        
-        extern "C" __global__
-        void stable_kernel(const DTYPE* x1, const DTYPE* x2, DTYPE* out,
-                           const int N, int M, int D) {
-            const int I = (blockIdx.x * blockDim.x) + threadIdx.x;
-            const int J = (blockIdx.y * blockDim.y) + threadIdx.y;
-
-            if (I >= N || J >= M) {
-                return;
-            }
-
-            DTYPE norm_x = (DTYPE) 0.0; //normf(D, &x1[I*D]);
-            DTYPE norm_y = (DTYPE) 0.0; //normf(D, &x2[J*D]);
-
-            #pragma unroll 
-            for (int k = 0; k < D; k += 1) {
-                norm_x = fma(x1[I * D + k], x1[I * D + k], norm_x);
-                norm_y = fma(x2[J * D + k], x2[J * D + k], norm_y);
-            }
-            norm_x = sqrt(norm_x);
-            norm_y = sqrt(norm_y);
-
-            DTYPE arg1 = (DTYPE) 0.0;
-            DTYPE arg2 = (DTYPE) 0.0;
-
-            #pragma unroll
-            for (int k = 0; k < D; k += 1) {
-                DTYPE x1_ik = x1[I * D + k];
-                DTYPE x2_jk = x2[J * D + k];
-                DTYPE a1 = norm_y * x1_ik - norm_x * x2_jk;
-                DTYPE a2 = norm_y * x1_ik + norm_x * x2_jk;
-
-                arg1 = fma(a1, a1, arg1);
-                arg2 = fma(a2, a2, arg2);
-            }
-            arg1 = sqrt(arg1);
-            arg2 = sqrt(arg2);
-
-            DTYPE angle = 2.0 * atan2(arg1, arg2);
-
-            #ifdef MULTIPLY_NORM
-            DTYPE norm_xy = norm_x * norm_y;
-            DTYPE K = norm_xy * (PI - angle) / PI;
-            #else
-            DTYPE K = (PI - angle) / PI;
-            #endif
-            
-            out[I * M + J] = K;
-        }
-        '''
         assert X1.dtype == X2.dtype == out.dtype, "X1, X2, and out don't have the same dtype"
         assert X1.device == X2.device == out.device, "X1, X2, and out are not on the same device"
+        if out.device.type == 'cpu':
+            self._apply_cpu(X1, X2, out)
+            return
         assert out.device.index is not None, "None device index"
 
-        if X1.dtype == torch.float32:
-            str_dtype = "float"
-            cupy_dtype = cp.float32
-        elif X1.dtype == torch.float64:
-            str_dtype = "double"
-            cupy_dtype = cp.float64
-        else:
+        if X1.dtype not in self._kernels:
             raise ValueError("Invalid dtype must be float32 or float64")
+        kernel, cupy_dtype = self._kernels[X1.dtype]
 
-        kernel_code = kernel_code.replace("DTYPE", str_dtype)
-        if self.multiply_norm:
-            kernel_code = kernel_code.replace("__MUL_NORM_DEFINE__", "#define MULTIPLY_NORM\n")
-        else:
-            kernel_code = kernel_code.replace("__MUL_NORM_DEFINE__", "\n")
-        kernel = cp.RawKernel(kernel_code, 'stable_kernel')
-
-        # The .contiguous should be a no-op in both these cases, but add them in for good measure
-        X1 = X1.contiguous()
-        X2 = X2.T.contiguous()
+        # X2 is passed in transposed (shape [D, M]). Rather than copying it back to a contiguous [M, D] matrix, we
+        # pass its strides to the CUDA kernel which reads it in place.
+        X1 = X1.contiguous()  # This should be a no-op but add it in for good measure
 
-        # Convert X1 and X2 to CuPy arrays.
+        # Convert X1, X2 and their row norms to CuPy arrays.
         x1cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X1))
         x2cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(X2))
-        with cp.cuda.Device(out.device.index):
+        x1_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X1, dim=1)))
+        x2_norms_cp = cp.fromDlpack(torch.utils.dlpack.to_dlpack(torch.norm(X2, dim=0)))
+        # Launch on PyTorch's current stream so the CUDA kernel is ordered after the torch.norm calls above
+        # (Falkon may call _apply from inside a non-default torch stream)
+        torch_stream = torch.cuda.current_stream(out.device)
+        with cp.cuda.Device(out.device.index), cp.cuda.ExternalStream(torch_stream.cuda_stream):
             outcp = cp.zeros((out.shape[0], out.shape[1]), dtype=cupy_dtype)
 
-        # Run the CUDA kernel to build the matrix K
-        pt_dim = int(X1.shape[1])
-        dims = int(X1.shape[0]), int(X2.shape[0])
-        threads_per_block = (16, 16)  # TODO: Maybe hardcoding this is bad
-        blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
-        kernel(blocks_per_grid, threads_per_block, (x1cp, x2cp, outcp, dims[0], dims[1], pt_dim))
-        cp.cuda.stream.get_current_stream().synchronize()  # Need to synchronize so we can copy to PyTorch
+            # Run the CUDA kernel to build the matrix K
+            pt_dim = int(X1.shape[1])
+            dims = int(X1.shape[0]), int(X2.shape[1])
+            x2_strides = int(X2.stride(1)), int(X2.stride(0))
+            threads_per_block = (16, 16)  # Must match TILE in the CUDA source
+            blocks_per_grid = tuple((dims[i] + threads_per_block[i] - 1) // threads_per_block[i] for i in range(2))
+            kernel(blocks_per_grid, threads_per_block,
+                   (x1cp, x2cp, x1_norms_cp, x2_norms_cp, outcp, dims[0], dims[1], pt_dim, *x2_strides))
+        torch_stream.synchronize()  # Need to synchronize so we can copy to PyTorch
 
-        # print("COPYING CUPY OUT TO PYTORCH")
-        # print("OUT CUPY\n", outcp)
         # Copy the kernel back into the output PyTorch tensor
         outcp_dlpack = outcp.toDlpack()
         out_dlpack = torch.utils.dlpack.from_dlpack(outcp_dlpack)
         out.copy_(out_dlpack)
-        # print("OUT PYTORCH\n", out)
 
-        # rand_idx_i, rand_idx_j = np.random.randint(X1.shape[0]), np.random.randint(X2.shape[0])
-        # xi, xj = X1[rand_idx_i].detach().cpu().numpy(), X2[rand_idx_j].detach().cpu().numpy()
-        # nxi, nxj = np.linalg.norm(xi), np.linalg.norm(xj)
-        # angle1, angle2 = np.linalg.norm(nxj * xi - nxi * xj), np.linalg.norm(nxj * xi + nxi * xj)
-        # angle = 2.0 * np.arctan2(angle1, angle2)
-        # kij = nxi * nxj * (np.sin(angle) + (1.0 + self.variance) * (np.pi - angle) * np.cos(angle)) / np.pi
-        # print(np.abs(kij - out[rand_idx_i, rand_idx_j].item()))
+    def _apply_cpu(self, X1: torch.Tensor, X2: torch.Tensor, out: torch.Tensor):
+        for rows, x1_norms, x2_norms, angle, _ in _norms_and_angle_blocks_torch(X1, X2):
+            out_rows = out[rows]
+            torch.neg(angle, out=out_rows).add_(np.pi).div_(np.pi)
+            if self.multiply_norm:
+                out_rows.mul_(x1_norms).mul_(x2_norms)
 
     def _apply_sparse(self, X1: SparseTensor, X2: SparseTensor, out: torch.Tensor):
         raise NotImplementedError("LinearAngleKernel does not implement sparse apply")
 
     def _finalize(self, A: torch.Tensor, d):
-        if self.debug:
+        if _DEBUG:
             print(f"LinearAngleKernel._finalize(A={A.shape}, d)")
         return A
 
@@ -1,6 +1,5 @@
 import torch
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 
 
 def normalize_pointcloud_transform(x):
@@ -80,6 +79,18 @@ def scale_bounding_box_diameter(bbox, scale):
     return scaled_bb_min, scaled_bb_size
 
 
+def homogeneous_points(x):
+    """
+    Convert a point cloud to homogeneous coordinates by appending a coordinate of 1 to each point
+    :param x: A point cloud represented as a tensor of shape [N, D]
+    :return: A tensor of shape [N, D + 1] with the same dtype and device as x
+    """
+    x_h = torch.empty(x.shape[0], x.shape[1] + 1, dtype=x.dtype, device=x.device)
+    x_h[:, :-1] = x
+    x_h[:, -1] = 1.0
+    return x_h
+
+
 def triple_points_along_normals(x, n, eps, homogeneous=False):
     """
     Convert a point cloud equipped with normals into a point cloud with points pertubed along those normals.
@@ -91,15 +102,20 @@ def triple_points_along_normals(x, n, eps, homogeneous=False):
     :param homogeneous: If true, return the points in homogeneous coordinates
     :return: A pair, (X, O) consisting of the new point cloud X and point occupancies O
     """
-    x_in = x - n * eps
-    x_out = x + n * eps
+    num_pts, dim = x.shape
 
-    x_triples = torch.cat([x, x_in, x_out], dim=0)
-    occ_triples = torch.cat([torch.zeros(x.shape[0]),
-                             -torch.ones(x.shape[0]),
-                             torch.ones(x.shape[0])]).to(x) * eps
+    # Write the tripled points (and occupancies) directly into their output tensors on the same device as x
+    # instead of building each copy of the points separately and concatenating them
+    x_triples = torch.empty(3 * num_pts, dim + 1 if homogeneous else dim, dtype=x.dtype, device=x.device)
+    x_triples[:num_pts, :dim] = x
+    x_triples[num_pts:2 * num_pts, :dim].copy_(n).mul_(-eps).add_(x)
+    x_triples[2 * num_pts:, :dim].copy_(n).mul_(eps).add_(x)
     if homogeneous:
-        x_triples = torch.cat([x_triples, torch.ones(x_triples.shape[0], 1, dtype=x_triples.dtype)], dim=-1)
+        x_triples[:, dim] = 1.0
+
+    occ_triples = torch.zeros(3 * num_pts, dtype=x.dtype, device=x.device)
+    occ_triples[num_pts:2 * num_pts] = -eps
+    occ_triples[2 * num_pts:] = eps
 
     return x_triples, occ_triples
 
@@ -114,10 +130,10 @@ def voxel_chunks(grid_size, cells_per_axis):
              in the current chunk
     """
     if np.isscalar(cells_per_axis):
-        cells_per_axis = torch.tensor([cells_per_axis] * len(grid_size)).to(torch.int32)
+        cells_per_axis = torch.tensor([cells_per_axis] * len(grid_size), dtype=torch.int32)
 
-    current_vox_min = torch.tensor([0.0, 0.0, 0.0]).to(torch.float64)
-    current_vox_max = torch.tensor([0.0, 0.0, 0.0]).to(torch.float64)
+    current_vox_min = torch.zeros(3, dtype=torch.float64)
+    current_vox_max = torch.zeros(3, dtype=torch.float64)
 
     cell_size_float = grid_size.to(torch.float64) / cells_per_axis
 
@@ -156,7 +172,6 @@ def cell_weights_trilinear(vmin, vmax, pvmin, pvmax):
     dmax = pvmax - vmax
     x, y, z = [np.unique(np.array([pvmin[i], pvmin[i] + 2.0 * dmin[i], pvmax[i] - 2.0 * dmax[i], pvmax[i]]))
                for i in range(3)]
-    vals = np.zeros([x.shape[0], y.shape[0], z.shape[0]])
     xyz = (x, y, z)
 
     one_idxs = []
@@ -171,19 +186,19 @@ def cell_weights_trilinear(vmin, vmax, pvmin, pvmax):
         else:
             one_idxs.append([1, 2])
 
-    for i in one_idxs[0]:
-        for j in one_idxs[1]:
-            for k in one_idxs[2]:
-                vals[i, j, k] = 1.0
-
-    f_w = RegularGridInterpolator((x, y, z), vals)
-
     psize = (pvmax - pvmin).numpy()
     pmin = (pvmin + 0.5).numpy()
     pmax = (pvmax - 0.5).numpy()
-    pts = np.stack([np.ravel(a) for a in
-                    np.mgrid[pmin[0]:pmax[0]:psize[0] * 1j,
-                             pmin[1]:pmax[1]:psize[1] * 1j,
-                             pmin[2]:pmax[2]:psize[2] * 1j]], axis=-1)
 
-    return torch.from_numpy(f_w(pts).reshape(psize)), pvmin, pvmax
+    # The control values are 1 on a box of grid nodes and 0 elsewhere, i.e. a product of one indicator per axis.
+    # Trilinear interpolation of such a product is the product of 1D linear interpolations along each axis, so we
+    # interpolate along the voxel centers of each axis and take an outer product instead of building and
+    # interpolating at every voxel center in the padded cell.
+    weights_1d = []
+    for dim in range(3):
+        vals = np.zeros(xyz[dim].shape[0])
+        vals[one_idxs[dim]] = 1.0
+        weights_1d.append(np.interp(np.linspace(pmin[dim], pmax[dim], psize[dim]), xyz[dim], vals))
+    weights = weights_1d[0][:, None, None] * weights_1d[1][None, :, None] * weights_1d[2][None, None, :]
+
+    return torch.from_numpy(weights), pvmin, pvmax
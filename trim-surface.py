@@ -46,8 +46,8 @@ def main():
         trim_dist_world = args.trim_distance * torch.norm(voxel_size).item()
     nn_dist, _ = pcu.k_nearest_neighbors(v, p, k=2)
     nn_dist = nn_dist[:, 1]
-    f_mask = np.stack([nn_dist[f[:, i]] < trim_dist_world for i in range(f.shape[1])], axis=-1)
-    f_mask = np.all(f_mask, axis=-1)
+    # Mark which vertices are close enough to the input, then keep faces whose vertices are all marked
+    f_mask = (nn_dist < trim_dist_world)[f].all(axis=-1)
     f = f[f_mask]
 
     print("Saving trimmed mesh...")